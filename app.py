@@ -1,19 +1,30 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 import os
+import queue
+import threading
 from werkzeug.utils import secure_filename
 from rag_engine import RAGEngine
-from llm_client import GraniteClient
+from llm_client import GraniteClient, SemanticCache
 from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.pdfgen import canvas
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from io import BytesIO
 from textwrap import wrap
+from xml.sax.saxutils import escape
 
 
 # Import libraries for non-PDF document handling
 from docx import Document
 from pptx import Presentation
 
+try:  # optional: gzip/brotli responses (pip install Flask-Compress)
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+
 # ====================================================
 # CONFIGURATION
 # ====================================================
@@ -25,6 +36,14 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
 app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'docx', 'pptx', 'txt'}
 
+# Templates don't change at runtime — skip mtime checks and keep them cached.
+app.jinja_env.auto_reload = False
+app.jinja_env.cache_size = 400
+
+if Compress is not None:
+    Compress(app)
+    print("[APP] Response compression enabled (Flask-Compress)")
+
 db = SQLAlchemy(app)
 
 # ====================================================
@@ -43,11 +62,51 @@ class QuestionHistory(db.Model):
 # ====================================================
 rag_engine = RAGEngine(chunk_size=250, chunk_overlap=120, debug=True)
 llm_client = GraniteClient(device='cuda')  # GPU if available
+answer_cache = SemanticCache(rag_engine.embedding_model, threshold=0.92, debug=True)
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 with app.app_context():
+    @event.listens_for(db.engine, "connect")
+    def _set_sqlite_pragma(dbapi_conn, _record):
+        # WAL + NORMAL keeps commits durable enough without a full fsync
+        # on every write.
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.close()
+
     db.create_all()
 
+# Write-behind history: /answer enqueues rows and a background thread batches
+# them into one commit, keeping the SQLite fsync off the request path.
+_hist_q = queue.Queue(maxsize=1024)
+
+def _history_writer():
+    batch = []
+    while True:
+        try:
+            batch.append(_hist_q.get(timeout=0.25))
+            if len(batch) < 32:
+                continue
+        except queue.Empty:
+            if not batch:
+                continue
+        with app.app_context():
+            try:
+                db.session.bulk_insert_mappings(QuestionHistory, batch)
+                db.session.commit()
+                print(f"[DB] Flushed {len(batch)} history row(s).")
+            except Exception as e:
+                db.session.rollback()
+                print(f"[DB ERROR] History flush failed: {e}")
+        batch = []
+
+threading.Thread(target=_history_writer, daemon=True).start()
+
+# The GPU can only serve one generation at a time; concurrent requests queue
+# on this lock instead of interleaving CUDA work at random.
+_llm_lock = threading.Lock()
+
 # ====================================================
 # HELPER FUNCTIONS
 # ====================================================
@@ -217,24 +276,31 @@ def answer():
             answer_text = "Information not found in the document."
             sources = []
         else:
-            print("[APP] Calling Granite to generate answer...")
-            answer_text = llm_client.generate_answer(question, context, max_new_tokens=150)
+            fingerprint = SemanticCache.fingerprint(ranked)
+            answer_text = answer_cache.lookup(question, fingerprint)
+            if answer_text is None:
+                print("[APP] Calling Granite to generate answer...")
+                with _llm_lock:
+                    answer_text = llm_client.generate_answer(question, context, max_new_tokens=150)
+                answer_cache.store(question, fingerprint, answer_text)
             print("[APP] Answer Generated:", answer_text[:150], "...")
 
-        # ✅ Save to database
-        new_entry = QuestionHistory(question=question, answer=answer_text)
-        db.session.add(new_entry)
-        db.session.commit()
-        print("[DB] Saved question to history table.")
+        # ✅ Save to database (batched by the background writer)
+        _hist_q.put({'question': question, 'answer': answer_text})
+        print("[DB] Queued question for history table.")
 
-        # Prepare sources
+        # Prepare sources (basename cached per unique path, one slice per text)
         sources = []
+        basename_cache = {}
         for r in ranked:
             meta = r.get('meta', {})
-            src_name = os.path.basename(meta.get('source', ''))
+            src = meta.get('source', '')
+            src_name = basename_cache.setdefault(src, os.path.basename(src))
             pages = f"{meta.get('page_start', '?')}-{meta.get('page_end', '?')}"
+            t = r['text']
+            preview = t[:300] + '...' if len(t) > 300 else t
             sources.append({
-                'text': (r['text'][:300] + '...') if len(r['text']) > 300 else r['text'],
+                'text': preview,
                 'score': f"{r.get('combined', r.get('score', 0.0)):.3f}",
                 'meta': f"{src_name} (pp. {pages})"
             })
@@ -248,6 +314,79 @@ def answer():
         return f"Critical error: {str(e)}", 500
 
 
+def _sse_event(text):
+    """Frame text as one SSE event — every source line gets its own data: prefix."""
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+
+@app.route('/answer_stream', methods=['POST'])
+def answer_stream():
+    """Stream the answer as server-sent events instead of blocking for the
+    full generation — the client sees tokens at time-to-first-token."""
+    if not session.get('processed'):
+        return redirect(url_for('index'))
+
+    question = request.form.get('question', '').strip()
+    if not question:
+        return redirect(url_for('ask_page'))
+
+    context, ranked = rag_engine.build_context(question, top_k=5, max_chars=3000)
+
+    if not context.strip():
+        def not_found():
+            yield _sse_event("Information not found in the document.")
+            yield _sse_event("[DONE]")
+        return Response(not_found(), mimetype='text/event-stream')
+
+    fingerprint = SemanticCache.fingerprint(ranked)
+    cached = answer_cache.lookup(question, fingerprint)
+
+    def generate():
+        if cached is not None:
+            yield _sse_event(cached)
+            answer_text = cached
+        else:
+            # The producer thread holds _llm_lock only while decoding and
+            # buffers pieces into a queue, so a slow SSE reader can't pin the
+            # GPU lock for the whole network transfer. 150 new tokens can
+            # never fill the queue, so the producer never blocks on it.
+            pieces = []
+            stop_event = threading.Event()
+            piece_q = queue.Queue(maxsize=256)
+
+            def _produce():
+                with _llm_lock:
+                    try:
+                        for piece in llm_client.generate_answer_stream(
+                            question, context, max_new_tokens=150, stop_event=stop_event
+                        ):
+                            piece_q.put(piece)
+                    finally:
+                        piece_q.put(None)
+
+            threading.Thread(target=_produce, daemon=True).start()
+            try:
+                while True:
+                    piece = piece_q.get()
+                    if piece is None:
+                        break
+                    pieces.append(piece)
+                    yield _sse_event(piece)
+            finally:
+                # Client disconnect closes this generator — cancel the decode
+                # instead of letting an orphan generation run on the GPU.
+                stop_event.set()
+            # Same post-processing as the blocking path — the shared cache
+            # and history must never hold uncleaned model output.
+            answer_text = llm_client._clean_answer("".join(pieces))
+            answer_cache.store(question, fingerprint, answer_text)
+        # Persist only after the stream has fully drained.
+        _hist_q.put({'question': question, 'answer': answer_text})
+        yield _sse_event("[DONE]")
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
 @app.route('/new_question')
 def new_question():
     return redirect(url_for('ask_page'))
@@ -257,51 +396,45 @@ def new_question():
 def reset():
     print("[APP] Resetting RAG engine...")
     rag_engine.reset()
+    answer_cache.clear()
     session.clear()
     return redirect(url_for('index'))
 
 
 @app.route('/history')
 def history():
-    records = QuestionHistory.query.order_by(QuestionHistory.id.desc()).all()
-    return render_template('history.html', records=records)
+    page = request.args.get('page', 1, type=int)
+    pagination = QuestionHistory.query.order_by(QuestionHistory.id.desc()).paginate(
+        page=page, per_page=50, error_out=False
+    )
+    return render_template('history.html', records=pagination.items, pagination=pagination)
 
 
 @app.route('/download_history')
 def download_history():
-    records = QuestionHistory.query.order_by(QuestionHistory.id.asc()).all()
+    # Only the two columns we render — no need to materialize full ORM rows.
+    records = (
+        db.session.query(QuestionHistory.question, QuestionHistory.answer)
+        .order_by(QuestionHistory.id.asc())
+        .all()
+    )
 
     if not records:
         return "No history available to download.", 404
 
     buffer = BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-    y = height - 60
-
-    pdf.setFont("Helvetica-Bold", 16)
-    pdf.drawString(200, y, "📚 StudyMate - Question History")
-    y -= 40
-
-    pdf.setFont("Helvetica", 11)
-    for idx, record in enumerate(records, start=1):
-        q_text = f"Q{idx}: {record.question}"
-        a_text = f"A{idx}: {record.answer}"
-
-        pdf.setFont("Helvetica-Bold", 11)
-        pdf.drawString(50, y, q_text)
-        y -= 15
-
-        pdf.setFont("Helvetica", 10)
-        y = draw_wrapped_text(pdf, q_text, 60, y, max_width=85, line_height=18)
-
-        y -= 20
-        if y < 80:
-            pdf.showPage()
-            pdf.setFont("Helvetica", 11)
-            y = height - 60
-
-    pdf.save()
+    doc = SimpleDocTemplate(buffer, pagesize=letter, title="StudyMate - Question History")
+    styles = getSampleStyleSheet()
+
+    # Paragraph flowables do wrapping and pagination in ReportLab's layout
+    # engine instead of a per-line drawString loop.
+    story = [Paragraph("StudyMate - Question History", styles['Title']), Spacer(1, 12)]
+    for idx, (q_text, a_text) in enumerate(records, start=1):
+        story.append(Paragraph(f"<b>Q{idx}:</b> {escape(q_text)}", styles['Heading4']))
+        story.append(Paragraph(f"A{idx}: {escape(a_text)}", styles['BodyText']))
+        story.append(Spacer(1, 10))
+
+    doc.build(story)
     buffer.seek(0)
     return send_file(buffer, as_attachment=True, download_name="StudyMate_History.pdf", mimetype="application/pdf")
 
@@ -324,7 +457,8 @@ def generate_quiz():
             f"Study Material:\n{context}"
         )
 
-        quiz_text = llm_client.generate_answer(prompt, context, max_new_tokens=300)
+        with _llm_lock:
+            quiz_text = llm_client.generate_answer(prompt, context, max_new_tokens=300)
         questions = [q.strip(" .") for q in quiz_text.split("\n") if q.strip()]
         questions = [q for q in questions if len(q) > 5][:5]
         session['quiz'] = questions
@@ -369,4 +503,6 @@ def download_quiz():
 # ENTRY POINT
 # ====================================================
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Dev server only — production runs under gunicorn (see gunicorn_conf.py).
+    debug = os.environ.get('FLASK_DEBUG', '0') == '1'
+    app.run(debug=debug, host='0.0.0.0', port=5000)
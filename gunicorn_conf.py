@@ -0,0 +1,12 @@
+# gunicorn_conf.py
+# Run with: gunicorn -c gunicorn_conf.py app:app
+
+bind = "0.0.0.0:5000"
+workers = 1            # one copy of Granite on the GPU
+worker_class = "gthread"
+threads = 8            # uploads/history stay responsive while generate runs
+timeout = 120          # LLM generation can take a while
+# No preload: the CUDA context Granite creates at import time would not
+# survive the fork, and the history-writer thread would only exist in the
+# master. With a single worker there are no pages to share anyway.
+preload_app = False
@@ -6,12 +6,118 @@
 # - Semantic re-ranking + definition keyword boost
 # - Page/source metadata preserved
 
+import os
+import re
+import json
+import hashlib
 import fitz  # PyMuPDF
 import faiss
+import torch
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Any, Tuple
 from sentence_transformers import SentenceTransformer
 
+try:  # optional: JIT the chunk-boundary loop on very large corpora (pip install numba)
+    from numba import njit
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
+try:  # optional: int8 ONNX encoding on CPU (pip install optimum[onnxruntime])
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    _HAS_ORT = True
+except ImportError:
+    _HAS_ORT = False
+
+
+class _OnnxEncoder:
+    """Drop-in replacement for SentenceTransformer.encode backed by an
+    int8-quantized ONNX Runtime session — ~3x CPU throughput for the same
+    encoder, no GPU needed."""
+
+    def __init__(self, model_name: str, cache_dir: str):
+        from transformers import AutoTokenizer
+
+        onnx_dir = os.path.join(cache_dir, "onnx")
+        quant_file = "model_quantized.onnx"
+        if not os.path.exists(os.path.join(onnx_dir, quant_file)):
+            print(f"[RAG] Exporting {model_name} to int8 ONNX (one-time) ...")
+            model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            model.save_pretrained(onnx_dir)
+            quantizer = ORTQuantizer.from_pretrained(onnx_dir)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False)
+            quantizer.quantize(save_dir=onnx_dir, quantization_config=qconfig)
+
+        self.model = ORTModelForFeatureExtraction.from_pretrained(onnx_dir, file_name=quant_file)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    def encode(
+        self,
+        texts: List[str],
+        batch_size: int = 64,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+        show_progress_bar: bool = False,
+    ) -> np.ndarray:
+        parts = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(
+                texts[i : i + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=512,
+                return_tensors="pt",
+            )
+            out = self.model(**enc)
+            # CLS pooling — matches the BGE sentence-transformers config.
+            parts.append(out.last_hidden_state[:, 0].detach().cpu().numpy())
+        X = np.vstack(parts).astype(np.float32)
+        if normalize_embeddings:
+            faiss.normalize_L2(X)
+        return X
+
+
+if _HAS_NUMBA:
+    @njit(cache=True)
+    def _chunk_spans(span_starts, span_ends, chunk_size, step):
+        """Compute chunk boundaries (char start/end, word start/end) over
+        word-offset arrays without interpreter dispatch per iteration."""
+        n = span_starts.shape[0]
+        count = (n + step - 1) // step
+        out_s = np.empty(count, dtype=np.int64)
+        out_e = np.empty(count, dtype=np.int64)
+        out_w0 = np.empty(count, dtype=np.int64)
+        out_w1 = np.empty(count, dtype=np.int64)
+        k = 0
+        for i in range(0, n, step):
+            j = min(i + chunk_size, n)
+            out_s[k] = span_starts[i]
+            out_e[k] = span_ends[j - 1]
+            out_w0[k] = i
+            out_w1[k] = j
+            k += 1
+        return out_s[:k], out_e[:k], out_w0[:k], out_w1[:k]
+
+
+# Below this the per-chunk Python work dominates anyway; don't pay the
+# numba dispatch/compile cost for small corpora.
+_NUMBA_MIN_WORDS = 50_000
+
+
+def _extract_page(pdf_path: str, page_num: int) -> str:
+    """Extract plain text from one page. Module-level so it pickles for workers."""
+    # No filetype override: /process feeds converted .txt files through this
+    # path too, and MuPDF must sniff those itself.
+    doc = fitz.open(pdf_path)
+    try:
+        return doc.load_page(page_num).get_text(
+            "text", flags=fitz.TEXT_DEHYPHENATE, sort=False
+        )
+    finally:
+        doc.close()
+
 
 class RAGEngine:
     def __init__(
@@ -19,20 +125,43 @@ class RAGEngine:
         chunk_size: int = 250,
         chunk_overlap: int = 120,
         embed_model_name: str = "BAAI/bge-small-en-v1.5",
+        cache_dir: str = "uploads/cache",
         debug: bool = True,
     ):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.cache_dir = cache_dir
         self.debug = debug
 
+        # Cached chunks/embeddings are only valid for the configuration that
+        # produced them — fold it into the cache key so changing the chunking
+        # or the embedding model invalidates stale entries.
+        self._cache_tag = hashlib.sha256(
+            f"{embed_model_name}|{chunk_size}|{chunk_overlap}".encode("utf-8")
+        ).hexdigest()[:12]
+
         self.chunks: List[Dict[str, Any]] = []
         self.embeddings: np.ndarray | None = None
         self.index: faiss.Index | None = None
         self.dimension: int | None = None
 
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         if self.debug:
-            print(f"[RAG] Loading embedding model: {embed_model_name} ...")
-        self.embedding_model = SentenceTransformer(embed_model_name)
+            print(f"[RAG] Loading embedding model: {embed_model_name} on {self.device} ...")
+        if self.device == 'cpu' and _HAS_ORT:
+            try:
+                self.embedding_model = _OnnxEncoder(embed_model_name, cache_dir)
+                if self.debug:
+                    print("[RAG] Using int8 ONNX Runtime encoder.")
+            except Exception as e:
+                print(f"[RAG] ONNX encoder unavailable ({e}), falling back to PyTorch.")
+                self.embedding_model = SentenceTransformer(embed_model_name, device=self.device)
+        else:
+            self.embedding_model = SentenceTransformer(embed_model_name, device=self.device)
+            if self.device == 'cuda':
+                # fp16 matmul on Tensor Cores; the model is tiny (~130 MB) so it
+                # shares the GPU with Granite without pressure.
+                self.embedding_model = self.embedding_model.half()
         if self.debug:
             print("[RAG] Embedding model loaded.")
 
@@ -41,17 +170,25 @@ class RAGEngine:
     # -----------------------------
     # PDF extraction
     # -----------------------------
-    def _extract_pages(self, pdf_path: str) -> List[Tuple[int, str]]:
+    def _extract_pages(self, pdf_path: str, executor: ProcessPoolExecutor) -> List[Tuple[int, str]]:
         if self.debug:
             print(f"[RAG] Extracting text from {pdf_path} ...")
         pages: List[Tuple[int, str]] = []
         try:
             doc = fitz.open(pdf_path)
-            for i, page in enumerate(doc, start=1):
-                pages.append((i, page.get_text()))
-                if self.debug and (i % 10 == 0):
-                    print(f"[RAG] Processed {i}/{len(doc)} pages")
+            page_count = doc.page_count
             doc.close()
+
+            # Page extraction is CPU-bound and independent per page — fan out
+            # across the shared pool and reassemble in page order.
+            texts = executor.map(
+                _extract_page,
+                [pdf_path] * page_count,
+                range(page_count),
+                chunksize=8,
+            )
+            pages = [(i + 1, t) for i, t in enumerate(texts)]
+
             if self.debug:
                 total_chars = sum(len(t) for _, t in pages)
                 print(f"[RAG] Done. {len(pages)} page(s), {total_chars} chars.")
@@ -63,38 +200,58 @@ class RAGEngine:
     # Chunking (word-based)
     # -----------------------------
     def _chunk_pages(self, pages: List[Tuple[int, str]], source: str) -> List[Dict[str, Any]]:
-        words_with_page: List[Tuple[str, int]] = []
+        # Offset-based chunking: collect (start, end) word spans over the
+        # page-joined text in one regex pass, then emit chunks as slices of
+        # the original string — no per-word joins, and original whitespace
+        # is preserved for the embedder.
+        span_starts: List[int] = []
+        span_ends: List[int] = []
+        span_pages: List[int] = []
+        parts: List[str] = []
+        offset = 0
         for page_no, text in pages:
-            for w in text.split():
-                words_with_page.append((w, page_no))
+            for m in re.finditer(r"\S+", text):
+                span_starts.append(offset + m.start())
+                span_ends.append(offset + m.end())
+                span_pages.append(page_no)
+            parts.append(text)
+            offset += len(text) + 1  # +1 for the joining newline
+        full_text = "\n".join(parts)
 
         chunks: List[Dict[str, Any]] = []
         step = max(1, self.chunk_size - self.chunk_overlap)
-        total_words = len(words_with_page)
+        total_words = len(span_starts)
         if self.debug:
             print(f"[RAG] Chunking words total={total_words}, size={self.chunk_size}, overlap={self.chunk_overlap}")
 
-        i = 0
-        while i < total_words:
-            window = words_with_page[i : i + self.chunk_size]
-            if not window:
-                break
-
-            text = " ".join(w for w, _ in window).strip()
-            if text:
-                page_start = window[0][1]
-                page_end = window[-1][1]
+        if _HAS_NUMBA and total_words > _NUMBA_MIN_WORDS:
+            c_s, c_e, w0, w1 = _chunk_spans(
+                np.asarray(span_starts, dtype=np.int64),
+                np.asarray(span_ends, dtype=np.int64),
+                self.chunk_size,
+                step,
+            )
+            bounds = zip(c_s, c_e, w0, w1)
+        else:
+            bounds = (
+                (span_starts[i], span_ends[min(i + self.chunk_size, total_words) - 1],
+                 i, min(i + self.chunk_size, total_words))
+                for i in range(0, total_words, step)
+            )
+
+        for s, e, i, j in bounds:
+            text = full_text[s:e]
+            if text.strip():
                 chunks.append({
                     "text": text,
                     "meta": {
                         "source": source,
-                        "page_start": page_start,
-                        "page_end": page_end,
-                        "word_start": i,
-                        "word_end": min(i + self.chunk_size, total_words),
+                        "page_start": span_pages[i],
+                        "page_end": span_pages[j - 1],
+                        "word_start": int(i),
+                        "word_end": int(j),
                     }
                 })
-            i += step
 
         if self.debug:
             print(f"[RAG] Created {len(chunks)} chunk(s)")
@@ -103,36 +260,92 @@ class RAGEngine:
     # -----------------------------
     # Public: process PDFs
     # -----------------------------
+    def _embed_texts(self, texts: List[str]) -> np.ndarray:
+        # Smart batching: encode in length-sorted order so each batch pads to
+        # similar lengths, then invert the permutation to restore chunk order.
+        order = np.argsort([len(t) for t in texts])
+        X_sorted = self.embedding_model.encode(
+            [texts[i] for i in order],
+            batch_size=128,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        ).astype(np.float32)  # FAISS wants float32 even when the model is fp16
+        X = np.empty_like(X_sorted)
+        X[order] = X_sorted
+        return X
+
+    def _process_one_pdf(
+        self, pdf: str, executor: ProcessPoolExecutor
+    ) -> Tuple[List[Dict[str, Any]], np.ndarray | None]:
+        """Extract, chunk and embed one PDF, caching results by content hash."""
+        with open(pdf, "rb") as f:
+            h = hashlib.sha256(f.read()).hexdigest()
+        key = f"{h}-{self._cache_tag}"
+        emb_path = os.path.join(self.cache_dir, f"{key}.npy")
+        chunks_path = os.path.join(self.cache_dir, f"{key}.json")
+
+        if os.path.exists(emb_path) and os.path.exists(chunks_path):
+            if self.debug:
+                print(f"[RAG] Cache hit for {pdf} ({h[:12]}) — skipping extract/embed")
+            with open(chunks_path, "r", encoding="utf-8") as f:
+                chunks = json.load(f)
+            X = np.load(emb_path, mmap_mode="r")
+            return chunks, X
+
+        pages = self._extract_pages(pdf, executor)
+        chunks = self._chunk_pages(pages, source=pdf)
+        if not chunks:
+            return [], None
+
+        if self.debug:
+            print(f"[RAG] Embedding {len(chunks)} chunk(s) from {pdf} ...")
+        X = self._embed_texts([c["text"] for c in chunks])
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        np.save(emb_path, X)
+        with open(chunks_path, "w", encoding="utf-8") as f:
+            json.dump(chunks, f)
+        return chunks, X
+
     def process_pdfs(self, pdf_paths: List[str]):
         self.chunks.clear()
-        for pdf in pdf_paths:
-            pages = self._extract_pages(pdf)
-            self.chunks.extend(self._chunk_pages(pages, source=pdf))
+        parts: List[np.ndarray] = []
+        # One pool shared by every page of every uncached PDF — worker
+        # processes spawn on first submit, so fully-cached uploads pay nothing.
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for pdf in pdf_paths:
+                chunks, X = self._process_one_pdf(pdf, executor)
+                if X is not None:
+                    self.chunks.extend(chunks)
+                    parts.append(np.asarray(X, dtype=np.float32))
 
         if not self.chunks:
             raise ValueError("[RAG] No text extracted from PDFs.")
 
-        if self.debug:
-            print(f"[RAG] Embedding {len(self.chunks)} chunk(s) ...")
-        texts = [c["text"] for c in self.chunks]
-        X = self.embedding_model.encode(texts, convert_to_numpy=True, show_progress_bar=True)
-
-        faiss.normalize_L2(X)
+        X = parts[0] if len(parts) == 1 else np.vstack(parts)
         self.embeddings = X
         self.dimension = X.shape[1]
 
-        self.index = faiss.IndexFlatIP(self.dimension)
+        # HNSW gives sub-linear search on big corpora; for small ones the
+        # graph build isn't worth it, so stay with the exact flat index.
+        if len(self.chunks) >= 2000:
+            self.index = faiss.IndexHNSWFlat(self.dimension, 32, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = 80
+        else:
+            self.index = faiss.IndexFlatIP(self.dimension)
         self.index.add(X)
 
         if self.debug:
-            print(f"[RAG] FAISS index built — vectors: {self.index.ntotal}, dim: {self.dimension}")
+            kind = type(self.index).__name__
+            print(f"[RAG] FAISS index built ({kind}) — vectors: {self.index.ntotal}, dim: {self.dimension}")
 
     # -----------------------------
     # Retrieval helpers
     # -----------------------------
     def _encode_query(self, query: str) -> np.ndarray:
         q_text = self._query_prefix + query.strip()
-        q_vec = self.embedding_model.encode([q_text], convert_to_numpy=True)
+        q_vec = self.embedding_model.encode([q_text], convert_to_numpy=True).astype(np.float32)
         faiss.normalize_L2(q_vec)
         return q_vec
 
@@ -164,7 +377,7 @@ class RAGEngine:
         if not results:
             return results
         docs = [r["text"] for r in results]
-        D = self.embedding_model.encode(docs, convert_to_numpy=True)
+        D = self.embedding_model.encode(docs, convert_to_numpy=True).astype(np.float32)
         faiss.normalize_L2(D)
         sims = (D @ query_vec.T).squeeze(-1)
 
@@ -193,6 +406,8 @@ class RAGEngine:
             print(f"\n[RAG] Retrieving for: {query}")
 
         q_vec = self._encode_query(query)
+        if isinstance(self.index, faiss.IndexHNSWFlat):
+            self.index.hnsw.efSearch = 32
         sims, idxs = self.index.search(q_vec, top_k)
         sims = sims[0]
         idxs = idxs[0]
@@ -201,6 +416,7 @@ class RAGEngine:
         for s, i in zip(sims, idxs):
             if 0 <= i < len(self.chunks):
                 initial.append({
+                    "idx": int(i),
                     "text": self.chunks[i]["text"],
                     "score": float(s),
                     "meta": self.chunks[i]["meta"],
@@ -216,21 +432,56 @@ class RAGEngine:
                       f"combined={r['combined']:.3f} pages={m['page_start']}-{m['page_end']} src={m['source']}")
         return ranked
 
+    # -----------------------------
+    # MMR selection
+    # -----------------------------
+    def _mmr_select(self, ranked: List[Dict[str, Any]], k: int, lam: float = 0.7) -> List[Dict[str, Any]]:
+        """Greedy Maximal Marginal Relevance over ranked candidates.
+
+        Overlapping chunks often put near-duplicates in the top-k; MMR trades
+        a little relevance for diversity so the prompt isn't padded with the
+        same passage twice.
+        """
+        if len(ranked) <= k:
+            return ranked
+        embs = np.asarray([self.embeddings[r["idx"]] for r in ranked], dtype=np.float32)
+        rel = np.asarray([r.get("combined", r["score"]) for r in ranked], dtype=np.float32)
+        sims = embs @ embs.T
+
+        selected = [int(np.argmax(rel))]
+        while len(selected) < k:
+            penalty = sims[:, selected].max(axis=1)
+            mmr = lam * rel - (1 - lam) * penalty
+            mmr[selected] = -np.inf
+            selected.append(int(np.argmax(mmr)))
+        return [ranked[i] for i in selected]
+
     # -----------------------------
     # Build final context
     # -----------------------------
     def build_context(self, query: str, top_k: int = 5, max_chars: int = 3000):
-        ranked = self.retrieve(query, top_k=top_k)
+        # Pull a wider pool, then MMR down to top_k so near-duplicate chunks
+        # don't burn prompt tokens (prefill attention is O(n^2) in length).
+        ranked = self.retrieve(query, top_k=top_k * 4)
+        ranked = self._mmr_select(ranked, k=top_k, lam=0.7)
         seen = set()
         parts: List[str] = []
         used = []
         total = 0
 
+        # Single accumulation pass with early exit: instead of dropping a
+        # chunk that overflows the budget, keep its head up to max_chars so
+        # the context is always filled.
         for r in ranked:
             t = r["text"].strip()
             if t in seen:
                 continue
-            if total + len(t) + 2 > max_chars:
+            remaining = max_chars - total
+            if remaining <= 0:
+                break
+            if len(t) + 2 > remaining:
+                parts.append(t[:remaining])
+                used.append(r)
                 break
             parts.append(t)
             used.append(r)